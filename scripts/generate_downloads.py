@@ -2,38 +2,375 @@
 from __future__ import annotations
 
 import argparse
-import logging
+import asyncio
+import functools
+import json
+import os
+import re
+import ssl
 import sys
+import tempfile
+from collections.abc import Mapping
 from collections.abc import Sequence
-from textwrap import dedent
-
-import requests
-from configupdater import ConfigUpdater
-from setup_logging import setup_logging
-
-URL_PATTERNS = {
-    'linux-arm': 'https://get.helm.sh/helm-%s-linux-arm.tar.gz',
-    'linux-arm64': 'https://get.helm.sh/helm-%s-linux-arm64.tar.gz',
-    'linux-riscv64': 'https://get.helm.sh/helm-%s-linux-riscv64.tar.gz',
-    'linux-386': 'https://get.helm.sh/helm-%s-linux-386.tar.gz',
-    'linux-amd64': 'https://get.helm.sh/helm-%s-linux-amd64.tar.gz',
-    'linux-ppc64le': 'https://get.helm.sh/helm-%s-linux-ppc64le.tar.gz',
-    'linux-s390x': 'https://get.helm.sh/helm-%s-linux-s390x.tar.gz',
-    'darwin-arm64': 'https://get.helm.sh/helm-%s-darwin-arm64.tar.gz',
-    'darwin-amd64': 'https://get.helm.sh/helm-%s-darwin-amd64.tar.gz',
-    'windows-arm64': 'https://get.helm.sh/helm-%s-windows-arm64.zip',
-    'windows-amd64': 'https://get.helm.sh/helm-%s-windows-amd64.zip',
-}
-
-
-def get_hash_from_url(url: str) -> str:
-    response = requests.get(url, verify=True)
-    response.raise_for_status()
-    hash = response.text.split()[0]
+from pathlib import Path
+from typing import NamedTuple
+
+import aiohttp
+
+
+class Platform(NamedTuple):
+    name: str
+    release_name: str
+    url_pattern: str
+    section: str
+    extract: str
+    markers: tuple[tuple[str, str], ...]
+
+
+PLATFORMS = (
+    Platform(
+        'linux-arm',
+        'Linux arm',
+        'https://get.helm.sh/helm-%s-linux-arm.tar.gz',
+        'helm',
+        'tar',
+        (('linux', 'armv6hf'), ('linux', 'armv7l')),
+    ),
+    Platform(
+        'linux-arm64',
+        'Linux arm64',
+        'https://get.helm.sh/helm-%s-linux-arm64.tar.gz',
+        'helm',
+        'tar',
+        (('linux', 'aarch64'),),
+    ),
+    Platform(
+        'linux-riscv64',
+        'Linux riscv64',
+        'https://get.helm.sh/helm-%s-linux-riscv64.tar.gz',
+        'helm',
+        'tar',
+        (('linux', 'riscv64'),),
+    ),
+    Platform(
+        'linux-386',
+        'Linux i386',
+        'https://get.helm.sh/helm-%s-linux-386.tar.gz',
+        'helm',
+        'tar',
+        (('linux', 'i386'), ('linux', 'i686')),
+    ),
+    Platform(
+        'linux-amd64',
+        'Linux amd64',
+        'https://get.helm.sh/helm-%s-linux-amd64.tar.gz',
+        'helm',
+        'tar',
+        (('linux', 'x86_64'),),
+    ),
+    Platform(
+        'linux-ppc64le',
+        'Linux ppc64le',
+        'https://get.helm.sh/helm-%s-linux-ppc64le.tar.gz',
+        'helm',
+        'tar',
+        (('linux', 'ppc64'), ('linux', 'ppc64le')),
+    ),
+    Platform(
+        'linux-s390x',
+        'Linux s390x',
+        'https://get.helm.sh/helm-%s-linux-s390x.tar.gz',
+        'helm',
+        'tar',
+        (('linux', 's390x'),),
+    ),
+    Platform(
+        'darwin-arm64',
+        'MacOS arm64',
+        'https://get.helm.sh/helm-%s-darwin-arm64.tar.gz',
+        'helm',
+        'tar',
+        (('darwin', 'arm64'),),
+    ),
+    Platform(
+        'darwin-amd64',
+        'MacOS amd64',
+        'https://get.helm.sh/helm-%s-darwin-amd64.tar.gz',
+        'helm',
+        'tar',
+        (('darwin', 'x86_64'),),
+    ),
+    Platform(
+        'windows-amd64',
+        'Windows amd64',
+        'https://get.helm.sh/helm-%s-windows-amd64.zip',
+        'helm.exe',
+        'zip',
+        (('win32', 'AMD64'), ('cygwin', 'x86_64')),
+    ),
+    Platform(
+        'windows-arm64',
+        'Windows arm64',
+        'https://get.helm.sh/helm-%s-windows-arm64.zip',
+        'helm.exe',
+        'zip',
+        (('win32', 'ARM64'), ('cygwin', 'aarch64')),
+    ),
+)
+
+RELEASE_URL = 'https://api.github.com/repos/helm/helm/releases/tags/%s'
+RELEASE_RE = re.compile(
+    r'^[ \t]*- \[(?P<name>[^\]]+)\]\((?P<url>[^)\s]+)\)[ \t]*'
+    r'\(\[checksum\]\([^)\s]+\)[ \t]*/[ \t]*(?P<sha256>[0-9a-f]{64})\)'
+    r'[ \t]*\r?$',
+    re.MULTILINE,
+)
+SHA256_RE = re.compile(r'[0-9a-f]{64}')
+TAG_RE = re.compile(r'v\d+\.\d+\.\d+(?:-[0-9A-Za-z.]+)?')
+
+SETUP_CFG = Path('setup.cfg')
+VERSION_RE = re.compile(r'^version[ \t]*=[ \t]*(?P<version>\S+)[ \t]*$', re.M)
+DOWNLOAD_SCRIPTS_RE = re.compile(
+    r'^download_scripts[ \t]*=.*(?:(?:\n[ \t]*)*\n[ \t]+\S.*)*',
+    re.M,
+)
+SECTION_RE = re.compile(r'^\[(?P<section>[^\]\n]+)\][ \t]*$', re.M)
+
+MAX_CONCURRENCY = 5
+MAX_RETRIES = 3
+RETRY_BACKOFF_FACTOR = 0.3
+MAX_RETRY_AFTER = 60
+RETRY_STATUSES = frozenset((429, 502, 503, 504))
+
+CACHE_DIR = Path(
+    os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache',
+    'helm-binary-py',
+    'release-notes',
+)
+
+
+@functools.cache
+def ssl_context() -> ssl.SSLContext:
+    return ssl.create_default_context()
+
+
+async def fetch(
+    session: aiohttp.ClientSession,
+    url: str,
+    headers: Mapping[str, str] | None = None,
+) -> tuple[int, Mapping[str, str], bytes]:
+    attempt = 0
+    while True:
+        try:
+            async with session.get(url, headers=headers) as response:
+                if (
+                    response.status not in RETRY_STATUSES or
+                    attempt >= MAX_RETRIES
+                ):
+                    response.raise_for_status()
+                    content = await response.read()
+                    return response.status, response.headers, content
+                retry_after = response.headers.get('Retry-After', '')
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt >= MAX_RETRIES:
+                raise
+            retry_after = ''
+
+        if retry_after.isdigit():
+            delay = min(float(retry_after), MAX_RETRY_AFTER)
+        else:
+            delay = RETRY_BACKOFF_FACTOR * 2 ** attempt
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def get_hash_from_url(session: aiohttp.ClientSession, url: str) -> str:
+    _, _, content = await fetch(session, url)
+    fields = content.split(maxsplit=1)
+    hash = fields[0].decode('ascii', 'replace') if fields else ''
+    if SHA256_RE.fullmatch(hash) is None:
+        raise ValueError(f'{url} does not start with a sha256 checksum')
     return hash
 
 
+def read_cached_release(cache: Path) -> dict[str, str] | None:
+    try:
+        cached = json.loads(cache.read_text())
+        etag, body = cached['etag'], cached['body']
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if not isinstance(etag, str) or not isinstance(body, str):
+        return None
+    return {'etag': etag, 'body': body}
+
+
+def write_cached_release(cache: Path, etag: str, body: str) -> None:
+    tmp: Path | None = None
+    try:
+        cache.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            'w',
+            dir=cache.parent,
+            suffix='.tmp',
+            delete=False,
+        ) as f:
+            tmp = Path(f.name)
+            json.dump({'etag': etag, 'body': body}, f)
+        tmp.replace(cache)
+    except OSError:
+        # the cache only saves a download, never fail the run over it
+        if tmp is not None:
+            tmp.unlink(missing_ok=True)
+
+
+async def get_release_notes(
+    session: aiohttp.ClientSession,
+    tag: str,
+    refresh: bool = False,
+) -> str:
+    cache = CACHE_DIR / f'{tag}.json'
+    cached = read_cached_release(cache)
+    if cached is not None and not refresh:
+        return cached['body']
+
+    headers: dict[str, str] = {}
+    token = os.environ.get('GITHUB_TOKEN')
+    if token:
+        # only authenticated 304s are free of the rate limit
+        headers['Authorization'] = f'Bearer {token}'
+    if cached is not None:
+        headers['If-None-Match'] = cached['etag']
+
+    status, response_headers, content = await fetch(
+        session,
+        RELEASE_URL % tag,
+        headers,
+    )
+
+    if status == 304 and cached is not None:
+        return cached['body']
+
+    body = json.loads(content).get('body')
+    if not isinstance(body, str):
+        raise ValueError(f'Release {tag} has no release notes')
+
+    etag = response_headers.get('ETag')
+    if etag:
+        write_cached_release(cache, etag, body)
+
+    return body
+
+
+def extract_entries(body: str) -> dict[str, dict[str, str]]:
+    return {
+        m['name']: {
+            'url': m['url'],
+            'sha256': m['sha256'],
+        }
+        for m in RELEASE_RE.finditer(body)
+    }
+
+
+async def get_downloads(
+    version: str,
+    refresh: bool = False,
+) -> dict[str, dict[str, str]]:
+    if TAG_RE.fullmatch(version) is None:
+        raise ValueError(f'Invalid helm tag: {version!r}')
+
+    urls = {
+        platform.name: platform.url_pattern % version
+        for platform in PLATFORMS
+    }
+
+    connector = aiohttp.TCPConnector(ssl=ssl_context(), limit=MAX_CONCURRENCY)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        try:
+            body = await get_release_notes(session, version, refresh)
+        except (aiohttp.ClientError, ValueError) as e:
+            # rate limited, no GitHub release for the tag, or no notes
+            import logging
+
+            logging.getLogger().warning(
+                'Release notes for %s unavailable, '
+                'falling back to .sha256sum files: %s',
+                version,
+                e,
+            )
+            body = ''
+        entries = extract_entries(body)
+
+        # fall back to the per-platform checksum files for anything the
+        # release notes do not list
+        missing = [
+            platform.name for platform in PLATFORMS
+            if platform.release_name not in entries
+        ]
+        hashes = await asyncio.gather(
+            *(
+                get_hash_from_url(session, urls[platform] + '.sha256sum')
+                for platform in missing
+            ),
+        )
+
+    fallback = dict(zip(missing, hashes))
+
+    data: dict[str, dict[str, str]] = {}
+    for platform in PLATFORMS:
+        url = urls[platform.name]
+        if platform.name in fallback:
+            sha256 = fallback[platform.name]
+        else:
+            entry = entries[platform.release_name]
+            if entry['url'] != url:
+                raise ValueError(
+                    f'Release notes for {version} list {entry["url"]} '
+                    f'for {platform.name}, expected {url}',
+                )
+            sha256 = entry['sha256']
+        data[platform.name] = {
+            'url': url,
+            'sha256': sha256,
+        }
+
+    return data
+
+
+def find_option(
+    pattern: re.Pattern[str],
+    config: str,
+    section: str,
+) -> re.Match[str] | None:
+    for header in SECTION_RE.finditer(config):
+        if header['section'].strip() == section:
+            next_header = SECTION_RE.search(config, header.end())
+            end = next_header.start() if next_header else len(config)
+            return pattern.search(config, header.end(), end)
+    return None
+
+
+def render_download_scripts(data: Mapping[str, Mapping[str, str]]) -> str:
+    lines: list[str] = []
+    for platform in PLATFORMS:
+        lines.append(f'[{platform.section}]')
+        lines.append('group = helm-binary')
+        lines.extend(
+            f'marker = sys_platform == "{sys_platform}" and '
+            f'platform_machine == "{machine}"'
+            for sys_platform, machine in platform.markers
+        )
+        lines.append(f'url = {data[platform.name]["url"]}')
+        lines.append(f'sha256 = {data[platform.name]["sha256"]}')
+        lines.append(f'extract = {platform.extract}')
+        lines.append(f'extract_path = {platform.name}/{platform.section}')
+    return '\n'.join(lines)
+
+
 def main(argv: Sequence[str] | None = sys.argv[1:]) -> int:
+    import logging
+
+    from setup_logging import setup_logging
+
     setup_logging()
     logger = logging.getLogger()
 
@@ -44,123 +381,47 @@ def main(argv: Sequence[str] | None = sys.argv[1:]) -> int:
         type=str,
         help='Helm tag to generate download config for.',
     )
+    parser.add_argument(
+        '--refresh',
+        action='store_true',
+        help='Revalidate cached release notes with GitHub.',
+    )
 
     args = parser.parse_args(argv)
     logger.debug('Args: %s', args.__dict__)
 
-    config = ConfigUpdater()
-    config.read('setup.cfg')
+    config = SETUP_CFG.read_text()
 
-    config_version = config['metadata']['version'].value
-    if not isinstance(config_version, str):
-        raise ValueError('Metadata version must be of type: str')
+    version_match = find_option(VERSION_RE, config, 'metadata')
+    if version_match is None:
+        raise ValueError(f'Metadata version not found in {SETUP_CFG}')
 
+    config_version = version_match['version']
     config_tag = 'v' + config_version.removeprefix('v').split('-')[0]
 
     tag: str | None = args.tag
     version = tag if tag else config_tag
 
-    data: dict[str, dict[str, str]] = {}
-    for platform, url_pattern in URL_PATTERNS.items():
-        url = url_pattern % version
-        sha256_url = url + '.sha256sum'
-        sha256 = get_hash_from_url(sha256_url)
-        data[platform] = {
-            'url': url,
-            'sha256': sha256,
-        }
+    data = asyncio.run(get_downloads(version, args.refresh))
 
-    download_scripts = dedent(
-        f"""
-        [helm]
-        group = helm-binary
-        marker = sys_platform == "linux" and platform_machine == "armv6hf"
-        marker = sys_platform == "linux" and platform_machine == "armv7l"
-        url = {data["linux-arm"]["url"]}
-        sha256 = {data["linux-arm"]["sha256"]}
-        extract = tar
-        extract_path = linux-arm/helm
-        [helm]
-        group = helm-binary
-        marker = sys_platform == "linux" and platform_machine == "aarch64"
-        url = {data["linux-arm64"]["url"]}
-        sha256 = {data["linux-arm64"]["sha256"]}
-        extract = tar
-        extract_path = linux-arm64/helm
-        [helm]
-        group = helm-binary
-        marker = sys_platform == "linux" and platform_machine == "riscv64"
-        url = {data["linux-riscv64"]["url"]}
-        sha256 = {data["linux-riscv64"]["sha256"]}
-        extract = tar
-        extract_path = linux-riscv64/helm
-        [helm]
-        group = helm-binary
-        marker = sys_platform == "linux" and platform_machine == "i386"
-        marker = sys_platform == "linux" and platform_machine == "i686"
-        url = {data["linux-386"]["url"]}
-        sha256 = {data["linux-386"]["sha256"]}
-        extract = tar
-        extract_path = linux-386/helm
-        [helm]
-        group = helm-binary
-        marker = sys_platform == "linux" and platform_machine == "x86_64"
-        url = {data["linux-amd64"]["url"]}
-        sha256 = {data["linux-amd64"]["sha256"]}
-        extract = tar
-        extract_path = linux-amd64/helm
-        [helm]
-        group = helm-binary
-        marker = sys_platform == "linux" and platform_machine == "ppc64"
-        marker = sys_platform == "linux" and platform_machine == "ppc64le"
-        url = {data["linux-ppc64le"]["url"]}
-        sha256 = {data["linux-ppc64le"]["sha256"]}
-        extract = tar
-        extract_path = linux-ppc64le/helm
-        [helm]
-        group = helm-binary
-        marker = sys_platform == "linux" and platform_machine == "s390x"
-        url = {data["linux-s390x"]["url"]}
-        sha256 = {data["linux-s390x"]["sha256"]}
-        extract = tar
-        extract_path = linux-s390x/helm
-        [helm]
-        group = helm-binary
-        marker = sys_platform == "darwin" and platform_machine == "arm64"
-        url = {data["darwin-arm64"]["url"]}
-        sha256 = {data["darwin-arm64"]["sha256"]}
-        extract = tar
-        extract_path = darwin-arm64/helm
-        [helm]
-        group = helm-binary
-        marker = sys_platform == "darwin" and platform_machine == "x86_64"
-        url = {data["darwin-amd64"]["url"]}
-        sha256 = {data["darwin-amd64"]["sha256"]}
-        extract = tar
-        extract_path = darwin-amd64/helm
-        [helm.exe]
-        group = helm-binary
-        marker = sys_platform == "win32" and platform_machine == "AMD64"
-        marker = sys_platform == "cygwin" and platform_machine == "x86_64"
-        url = {data["windows-amd64"]["url"]}
-        sha256 = {data["windows-amd64"]["sha256"]}
-        extract = zip
-        extract_path = windows-amd64/helm.exe
-        [helm.exe]
-        group = helm-binary
-        marker = sys_platform == "win32" and platform_machine == "ARM64"
-        marker = sys_platform == "cygwin" and platform_machine == "aarch64"
-        url = {data["windows-arm64"]["url"]}
-        sha256 = {data["windows-arm64"]["sha256"]}
-        extract = zip
-        extract_path = windows-arm64/helm.exe
-        """,
-    ).strip()
-
-    config['setuptools_download']['download_scripts'].set_values(
-        download_scripts.splitlines(),
+    download_scripts = render_download_scripts(data)
+
+    download_scripts_block = '\n'.join(
+        ['download_scripts ='] +
+        [f'    {line}' for line in download_scripts.splitlines()],
+    )
+    download_scripts_match = find_option(
+        DOWNLOAD_SCRIPTS_RE,
+        config,
+        'setuptools_download',
+    )
+    if download_scripts_match is None:
+        raise ValueError(f'download_scripts not found in {SETUP_CFG}')
+    SETUP_CFG.write_text(
+        config[:download_scripts_match.start()] +
+        download_scripts_block +
+        config[download_scripts_match.end():],
     )
-    config.update_file()
 
     return 0
 